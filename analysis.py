@@ -3,23 +3,20 @@
 A Python script that uses networkx an matplotlib to measure aspects of networks
 """
 import networkx as nx
-from typing import List, Set
+import numpy as np
+from typing import List
 
 
 def calc_edge_density(graph: nx.Graph) -> float:
-    adj_mat = nx.to_numpy_matrix(graph)
-    num_edges = 0
-    for i in range(adj_mat.shape[0]):
-        for j in range(i+1, adj_mat.shape[1]):
-            if adj_mat[i][j] > 0:
-                num_edges += 1
-    density = num_edges / (adj_mat.shape[0]*(adj_mat.shape[0]-1)/2)
+    num_nodes = graph.number_of_nodes()
+    num_edges = graph.number_of_edges()
+    density = num_edges / (num_nodes*(num_nodes-1)/2)
     return density
 
 
-def get_component_sizes(graph) -> List[Set]:
+def get_component_sizes(graph) -> List[int]:
     """
-    returns a list of the components in graph
+    returns a list of the sizes of the components in graph
     :param graph: a networkx graph
     """
     return [len(cc) for cc in nx.connected_components(graph)]
@@ -30,4 +27,20 @@ def find_degree_assortativity_coeffecient(graph):
 
 
 def find_clustering_coefficients(graph):
-    return nx.clustering(graph)
+    """
+    Computes the same thing as nx.clustering, but with sparse matrix products.
+    """
+    # networkx can't build a matrix for a graph with no nodes
+    if graph.number_of_nodes() == 0:
+        return {}
+    adj_mat = nx.to_scipy_sparse_array(graph, weight=None, dtype=np.int64, format='csr')
+    # self loops don't count towards degree or triangles
+    adj_mat.setdiag(0)
+    adj_mat.eliminate_zeros()
+    degrees = adj_mat.sum(axis=1)
+    # this is the diagonal of A^3, which counts each triangle through a node twice
+    triangles = (adj_mat @ adj_mat).multiply(adj_mat).sum(axis=1)
+    possible_triangles = degrees * (degrees - 1)
+    coefficients = np.divide(triangles, possible_triangles, out=np.zeros(len(degrees)),
+                             where=possible_triangles > 0)
+    return dict(zip(graph.nodes, coefficients.tolist()))
@@ -3,7 +3,7 @@
 from tkinter import Frame, Listbox, StringVar, Tk, Button, Entry, Label
 from tkinter.constants import BOTTOM, END, LEFT, RIGHT
 import constants as cns
-from utility import ls_dir, run_cmd
+from utility import ls_dir, forget_dir, run_cmd, write_graph_text
 import sim
 import time
 
@@ -134,10 +134,9 @@ def run_vis_sim_screen(root: Tk, old_frame: Frame):
             if len(save_box.get()) > 0 else f'{cns.VIS_DIR}/tmp'
         summary_box.config(text=summary, width=len(summary))
         with open(save_file_name, 'w') as vis_file:
-            with open(graph, 'r') as graph_file:
-                graph_text = graph_file.readlines()
-                vis_file.writelines(graph_text + ([] if graph_text[-1] == '\n' else ['\n']))
-                vis_file.write(output)
+            write_graph_text(graph, vis_file)
+            vis_file.write(output)
+        forget_dir(cns.VIS_DIR)
         run_cmd(cns.VIS_BIN, save_file_name)
     run_button = Button(frame, command=run, text='Run')
 
@@ -1,8 +1,14 @@
 #!/usr/bin/python3
+import os
+import re
+import tempfile
+import zipfile
 import numpy as np
+from itertools import takewhile
+from scipy.sparse import csr_matrix, load_npz, save_npz
 from typing import Iterable, Tuple, Callable
 from enum import IntEnum
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from numba import njit, prange
 import time
 
@@ -16,15 +22,24 @@ class State(IntEnum):
 
 Disease = namedtuple('Disease', 'days_exposed days_infectious transmission_prob')
 
-# Mutates an empty ndarray to create a starting SEIR configuration for a simulation
-SEIRInitFunc = Callable[[np.ndarray], None]
+# Creates a starting SEIR configuration for a simulation on a graph with the given number of nodes
+SEIRInitFunc = Callable[[int], np.ndarray]
+
+rng = np.random.default_rng()
+
+# the number of parsed graphs that read_adj_list keeps around
+ADJ_CACHE_SIZE = 8
+# (file name, modification time) -> adjacency matrix, least recently used first
+_adj_cache: 'OrderedDict[Tuple[str, int], csr_matrix]' = OrderedDict()
+# parsed graphs are also saved in this directory next to each graph file
+ADJ_CACHE_DIR = '.cache'
 
 
 def seir_list_to_ndarray(node_states: Iterable[Tuple[int, State]]) -> np.ndarray:
-    nodes = np.fromiter((x[0] for x in node_states), dtype=np.int)
-    states = np.fromiter((x[1].value for x in node_states), dtype=np.int)
-    seir = np.zeros((len(node_states), 4))
-    seir[nodes, states] = 1
+    node_to_state = np.fromiter((x for node, state in node_states for x in (node, state)),
+                                dtype=np.int64).reshape(-1, 2)
+    seir = np.zeros((node_to_state.shape[0], 4), dtype=np.int8)
+    seir[node_to_state[:, 0], node_to_state[:, 1]] = 1
     return seir
 
 
@@ -33,9 +48,11 @@ def visualize_sim(matrix_file_name: str, disease_file_name: str, num_steps: int)
     matrix = read_adj_list(matrix_file_name)
     disease, init_func = read_disease(disease_file_name)
     initial_seir = init_func(matrix.shape[0])
-    seirs = _simulate(matrix, initial_seir, num_steps, disease)
-    vis_str = make_visualization_str(seirs)
-    summary = '{:.4} ({:.3} s)'.format(_find_num_susceptible_nodes(seirs)/matrix.shape[0],
+    states = _simulate(matrix, initial_seir, num_steps, disease, record_history=True)
+    vis_str = make_visualization_str(states)
+    # without any steps, the starting state is also the final one
+    final_state = states[-1] if states.shape[0] > 0 else _seir_to_state(initial_seir)[0]
+    summary = '{:.4} ({:.3} s)'.format(_find_num_susceptible_nodes(final_state)/matrix.shape[0],
                                        time.time()-time_start)
     return vis_str, summary
 
@@ -44,79 +61,131 @@ def run_sim_batch(matrix_file_name: str, disease_file_name: str, num_steps: int,
                   num_sims: int) -> float:
     matrix = read_adj_list(matrix_file_name)
     disease, init_func = read_disease(disease_file_name)
-    initial_seir = init_func(matrix.shape[0])
-    num_susceptible = (_find_num_susceptible_nodes(_simulate(matrix, initial_seir, num_steps, disease))
-                       for _ in prange(num_sims))
-    proportion_susceptible = (x/matrix.shape[0] for x in num_susceptible)
-    return sum(proportion_susceptible)/num_sims
+    initial_state, initial_days = _seir_to_state(init_func(matrix.shape[0]))
+    return _run_batch(matrix.indptr, matrix.indices, initial_state, initial_days, num_steps,
+                      num_sims, disease.days_exposed, disease.days_infectious,
+                      disease.transmission_prob)
 
 
-def _simulate(matrix: np.ndarray, starting_seir: np.ndarray, num_steps: int,
-              disease: Disease) -> np.ndarray:
+@njit(parallel=True, cache=True)
+def _run_batch(indptr: np.ndarray, indices: np.ndarray, initial_state: np.ndarray,
+               initial_days: np.ndarray, num_steps: int, num_sims: int, days_exposed: int,
+               days_infectious: int, transmission_prob: float) -> float:
     """
-    :param matrix: adjacency matrix of graph
-    :param seir: starting numbers of s, e, i, r
+    Runs independent simulations in parallel from the same starting configuration.
+    :return: the average proportion of nodes left susceptible
+    """
+    num_nodes = initial_state.shape[0]
+    no_history = np.empty((0, num_nodes), dtype=np.int8)
+    total = 0.0
+    for _ in prange(num_sims):
+        state = initial_state.copy()
+        days = initial_days.copy()
+        _simulate_kernel(indptr, indices, state, days, num_steps,
+                         days_exposed, days_infectious, transmission_prob, no_history)
+        total += np.sum(state == State.S) / num_nodes
+    return total / num_sims
+
+
+def _seir_to_state(seir: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits an SEIR array into the State of each node and the number of days
+    each node has spent in that state.
+    """
+    state = np.argmax(seir > 0, axis=1).astype(np.int8)
+    days = seir.max(axis=1).astype(np.int32)
+    return state, days
+
+
+@njit(cache=True)
+def _simulate_kernel(indptr: np.ndarray, indices: np.ndarray, state: np.ndarray,
+                     days: np.ndarray, num_steps: int, days_exposed: int,
+                     days_infectious: int, transmission_prob: float,
+                     history: np.ndarray) -> None:
+    """
+    Runs a simulation in place.
+    :param indptr: index pointer array of the graph's CSR adjacency matrix
+    :param indices: column index array of the graph's CSR adjacency matrix
+    :param state: the State of each node
+    :param days: the number of days each node has spent in its current state
     :param num_steps: number of steps to run for
-    :return: An array containing the state history of each of the nodes.
-             The last index iterates over the steps.
+    :param history: receives the State of each node after every step.
+                    Pass an array with no rows to skip recording.
     """
-    seirs = np.zeros((num_steps, starting_seir.shape[0], starting_seir.shape[1]),
-                     dtype=starting_seir.dtype)
-    seir = np.copy(starting_seir)
+    num_nodes = state.shape[0]
+    record_history = history.shape[0] > 0
+    # the probability of being exposed by each possible number of infectious neighbors
+    max_degree = np.max(indptr[1:] - indptr[:-1]) if num_nodes > 0 else 0
+    # 1 - (1-p)^k, written this way to stay accurate when p is small
+    log_not_transmitted = np.log1p(-transmission_prob)
+    exposed_probs = -np.expm1(np.arange(max_degree + 1) * log_not_transmitted)
     for step in range(num_steps):
-        # Probabilistic vales to use during the simulation
-        probs = np.random.rand(len(matrix))
-        # Infectious to Recoved
-        to_r_filter = seir[:, 2] > disease.days_infectious
-        seir[to_r_filter, 3] = -1
-        seir[to_r_filter, 2] = 0
-        # Exposed to Infectious
-        to_i_filter = seir[:, 1] > disease.days_exposed
-        seir[to_i_filter, 2] = -1
-        seir[to_i_filter, 1] = 0
+        for u in range(num_nodes):
+            # Infectious to Removed
+            if state[u] == State.I and days[u] > days_infectious:
+                state[u] = State.R
+                days[u] = 0
+            # Exposed to Infectious
+            elif state[u] == State.E and days[u] > days_exposed:
+                state[u] = State.I
+                days[u] = 0
         # Susceptible to Exposed
-        i_filter = seir[:, 2] > 0
-        to_e_probs = 1 - (np.prod((1 - (matrix * disease.transmission_prob))[:, i_filter], axis=1))
-        to_e_filter = (seir[:, 0] > 0) & (probs < to_e_probs)
-        seir[to_e_filter, 1] = -1
-        seir[to_e_filter, 0] = 0
-        # Tracking days and seirs
-        seir[(seir > 0)] += 1
-        seir[(seir < 0)] = 1
-        seirs[step, :, :] = seir
-
-    return seirs
-
-
-@njit(parallel=True)
-def _find_num_susceptible_nodes(seirs: np.ndarray) -> int:
-    return np.sum(seirs[:, State.S.value, -1] > 0)
-
-
-def make_visualization_str(seirs: np.ndarray) -> str:
-    vis_str = ''
-    for step in range(seirs.shape[0]):
-        susceptible_nodes = np.where(seirs[step, :, State.S.value] > 0)[0]
-        exposed_nodes = np.where(seirs[step, :, State.E.value] > 0)[0]
-        infectious_nodes = np.where(seirs[step, :, State.I.value] > 0)[0]
-        removed_nodes = np.where(seirs[step, :, State.R.value] > 0)[0]
-
-        s_lines = '\n'.join(f'{node} {State.S.value}' for node in susceptible_nodes)
-        e_lines = '\n'.join(f'{node} {State.E.value}' for node in exposed_nodes)
-        i_lines = '\n'.join(f'{node} {State.I.value}' for node in infectious_nodes)
-        r_lines = '\n'.join(f'{node} {State.R.value}' for node in removed_nodes)
-        if len(s_lines) > 0:
-            vis_str += s_lines + '\n'
-        if len(e_lines) > 0:
-            vis_str += e_lines + '\n'
-        if len(i_lines) > 0:
-            vis_str += i_lines + '\n'
-        if len(r_lines) > 0:
-            vis_str += r_lines + '\n'
+        for u in range(num_nodes):
+            if state[u] != State.S:
+                continue
+            num_infectious_neighbors = 0
+            for idx in range(indptr[u], indptr[u+1]):
+                v = indices[idx]
+                # nodes that just became infectious don't spread the disease until the next step
+                if state[v] == State.I and days[v] > 0:
+                    num_infectious_neighbors += 1
+            if num_infectious_neighbors == 0:
+                continue
+            if np.random.random() < exposed_probs[num_infectious_neighbors]:
+                state[u] = State.E
+                days[u] = 0
+        # Tracking days and states
+        days += 1
+        if record_history:
+            history[step] = state
+
+
+def _simulate(matrix: csr_matrix, starting_seir: np.ndarray, num_steps: int,
+              disease: Disease, record_history: bool = False) -> np.ndarray:
+    """
+    :param matrix: adjacency matrix of graph
+    :param seir: starting numbers of s, e, i, r
+    :param num_steps: number of steps to run for
+    :param record_history: whether to keep the State of the nodes at every step
+    :return: If record_history is set, an array containing the State of each of the nodes
+             at every step. The first index iterates over the steps.
+             Otherwise, just the State of each of the nodes at the end.
+    """
+    state, days = _seir_to_state(starting_seir)
+    history = np.zeros((num_steps if record_history else 0, state.shape[0]), dtype=np.int8)
+    _simulate_kernel(matrix.indptr, matrix.indices, state, days, num_steps,
+                     disease.days_exposed, disease.days_infectious, disease.transmission_prob,
+                     history)
+    return history if record_history else state
+
+
+def _find_num_susceptible_nodes(state: np.ndarray) -> int:
+    return np.count_nonzero(state == State.S)
+
+
+def make_visualization_str(states: np.ndarray) -> str:
+    # every line that can show up, indexed by State and then by node
+    lines = np.array([[f'{node} {state.value}' for node in range(states.shape[1])]
+                      for state in State])
+    step_strs = []
+    for step_states in states:
+        # group the nodes by State, keeping each group in node order
+        order = np.argsort(step_states, kind='stable')
         # This extra newline is to separate the steps
-        vis_str += '\n'
+        step_strs.append('\n'.join(lines[step_states[order], order]) + '\n\n')
     # append 'end\n' because that's just what the visualizer program wants
-    return vis_str + 'end\n'
+    step_strs.append('end\n')
+    return ''.join(step_strs)
 
 
 def read_disease(file_name: str) -> Tuple[Disease, SEIRInitFunc]:
@@ -126,34 +195,95 @@ def read_disease(file_name: str) -> Tuple[Disease, SEIRInitFunc]:
     num_to_infect = int(fields[3])
 
     def init_func(num_nodes: int) -> np.ndarray:
-        nonlocal num_to_infect
         # the four is for the four states in SEIR
-        seir = np.zeros((num_nodes, 4), dtype=np.int32)
-        to_infect = np.random.randint(seir.shape[0], size=num_to_infect)
-        susceptible_nodes = np.array([node for node in range(num_nodes)
-                                      if node not in to_infect])
+        seir = np.zeros((num_nodes, 4), dtype=np.int8)
+        # sampling without replacement can't pick more nodes than there are
+        to_infect = rng.choice(num_nodes, size=min(num_to_infect, num_nodes), replace=False)
+        susceptible_filter = np.ones(num_nodes, dtype=bool)
+        susceptible_filter[to_infect] = False
         seir[to_infect, State.I.value] = 1
-        seir[susceptible_nodes, State.S.value] = 1
+        seir[susceptible_filter, State.S.value] = 1
         return seir
 
     return disease, init_func
 
 
-def read_adj_list(file_name) -> np.ndarray:
+def read_adj_list(file_name) -> csr_matrix:
     """
     This reads in the data from half a symmetric matrix and mirrors it.
     If the whole matrix is present in the file, that won't cause problems.
     This cannot read unsymmetric matrices.
+    Recently read files are cached in memory and on disk until they are modified.
+    :return: the adjacency matrix in compressed sparse row format
     """
+    key = (file_name, os.stat(file_name).st_mtime_ns)
+    if key in _adj_cache:
+        _adj_cache.move_to_end(key)
+    else:
+        _adj_cache[key] = _load_adj_list(*key)
+        if len(_adj_cache) > ADJ_CACHE_SIZE:
+            _adj_cache.popitem(last=False)
+    return _adj_cache[key].copy()
+
+
+def _load_adj_list(file_name: str, mtime: int) -> csr_matrix:
+    """
+    Loads a graph from the on-disk cache, parsing it and filling the cache if the
+    cache doesn't have the version of the file modified at mtime.
+    """
+    cache_dir = os.path.join(os.path.dirname(file_name), ADJ_CACHE_DIR)
+    base_name = os.path.basename(file_name)
+    cache_file_name = os.path.join(cache_dir, f'{base_name}.{mtime}.npz')
+    if os.path.exists(cache_file_name):
+        try:
+            return load_npz(cache_file_name)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # a damaged cache file is thrown away and replaced below
+            try:
+                os.remove(cache_file_name)
+            except OSError:
+                pass
+
+    matrix = _parse_adj_list(file_name)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # remove the copies of older versions of the file, along with temporary files
+        # left behind by interrupted writes, without touching other graphs' files
+        stale_pattern = re.compile(re.escape(base_name) + r'\.(\d+|tmp-\w+)\.npz')
+        for cached_file_name in os.listdir(cache_dir):
+            if stale_pattern.fullmatch(cached_file_name):
+                os.remove(os.path.join(cache_dir, cached_file_name))
+        # write to a temporary file first so that an interrupted write never
+        # leaves a partial file under the cache file's name
+        with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=f'{base_name}.tmp-',
+                                         suffix='.npz', delete=False) as tmp_file:
+            tmp_file_name = tmp_file.name
+        try:
+            save_npz(tmp_file_name, matrix, compressed=False)
+            # temporary files are only readable by their owner
+            os.chmod(tmp_file_name, 0o644)
+            os.replace(tmp_file_name, cache_file_name)
+        except BaseException:
+            os.remove(tmp_file_name)
+            raise
+    except OSError:
+        # the cache is just an optimization, so it's fine if it can't be written
+        pass
+    return matrix
+
+
+def _parse_adj_list(file_name) -> csr_matrix:
     with open(file_name, 'r') as f:
-        line = f.readline()
-        shape = (int(line[:-1]), int(line[:-1]))
-        matrix = np.zeros(shape, dtype=np.uint8)
-
-        line = f.readline()[:-1]
-        while len(line) > 0:
-            coord = line.split(' ')
-            matrix[int(coord[0]), int(coord[1])] = 1
-            matrix[int(coord[1]), int(coord[0])] = 1
-            line = f.readline()[:-1]
+        num_nodes = int(f.readline())
+        # the edges end at the first blank line
+        edges = np.loadtxt(takewhile(lambda line: len(line.strip()) > 0, f), dtype=np.int32)
+    # loadtxt flattens a single edge into one row
+    edges = edges.reshape(-1, 2)
+    # mirror the edges up front so that the matrix is built in one pass
+    rows = np.concatenate((edges[:, 0], edges[:, 1]))
+    cols = np.concatenate((edges[:, 1], edges[:, 0]))
+    data = np.ones(rows.shape[0], dtype=np.uint8)
+    matrix = csr_matrix((data, (rows, cols)), shape=(num_nodes, num_nodes))
+    # repeated edges get summed when building the matrix
+    matrix.data[:] = 1
     return matrix
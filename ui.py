@@ -3,9 +3,11 @@
 This is a ui script for the infection resistant network project. The goal is to bring
 all the tools together into one cohesive package to make experimenation easier.
 """
+import os
 import time
 from typing import Dict, Any, Tuple
-from utility import run_cmd, int_input, bool_input, float_input, int_list_input, read_adj_list
+from utility import run_cmd, run_cmd_async, finish_cmd, run_cmd_streaming, int_input, \
+    bool_input, float_input, int_list_input, ls_dir, forget_dir, write_graph_text
 from inspect import getmembers, isfunction
 import analysis as an
 import constants
@@ -24,23 +26,14 @@ def main_menu():
     :return: a function that does the next thing the user wants to do
     """
     selection = -1
-    # a collection of choices with an index, plain English name, and a function to call
-    choices = list(enumerate((('quit', exit),
-                             ('analyze graph', analyze_graph),
-                             ('run simulation batch', run_simulation_batch),
-                             ('visualize simulation', visualize_sim),
-                             ('load visualization', load_visualization),
-                             ('create a new disease', create_new_disease))))
-    valid_numbers = list(map(lambda c: c[0], choices))
-
-    while selection not in valid_numbers:
+    while selection not in _MENU_MAP:
         print('Select an option:')
-        for choice in choices:
-            print(f'{choice[0]} {choice[1][0]}')
+        for i, (name, _) in enumerate(_MENU):
+            print(f'{i} {name}')
         selection = int_input()
 
     # return the function to call
-    return dict(choices)[selection][1]
+    return _MENU_MAP[selection]
 
 
 def analyze_graph():
@@ -55,11 +48,28 @@ def analyze_graph():
         selections = int_list_input('? ')
 
     analyses = (choices[sel][1] for sel in selections)
-    graph = nx.Graph(read_adj_list(graph_name))
+    graph = load_graph(graph_name)
     for analysis in analyses:
         print(analysis(graph))
 
 
+# graph file name -> (modification time, the graph built from it)
+_graphs: Dict[str, Tuple[int, nx.Graph]] = {}
+
+
+def load_graph(file_name: str) -> nx.Graph:
+    """
+    Builds a networkx graph from an adjacency list file. The graph is reused until
+    the file is modified, so analyzing the same graph again doesn't rebuild it.
+    """
+    # sim imports numba, which is slow to load, so it is only imported when a graph is read
+    from sim import read_adj_list
+    mtime = os.stat(file_name).st_mtime_ns
+    if file_name not in _graphs or _graphs[file_name][0] != mtime:
+        _graphs[file_name] = (mtime, nx.Graph(read_adj_list(file_name)))
+    return _graphs[file_name][1]
+
+
 def run_simulation_batch():
     """
     Runs a group of simulations and displays a summary of the results
@@ -68,8 +78,13 @@ def run_simulation_batch():
     disease_name = select_file_from_dir(constants.DISEASE_DIR, 'Select a disease to use:')
     num_simulations = int_input('How many simulations? ')
     sim_length = int_input('How many steps for each simulation? ')
-    output = run_cmd(constants.SIM_BIN, disease_name, graph_name,
-                     str(num_simulations), str(sim_length))
+    # the simulations are independent, so split them between one process per core
+    num_processes = max(1, min(os.cpu_count() or 1, num_simulations))
+    chunk_size, remainder = divmod(num_simulations, num_processes)
+    processes = [run_cmd_async(constants.SIM_BIN, disease_name, graph_name,
+                               str(chunk_size + (1 if i < remainder else 0)), str(sim_length))
+                 for i in range(num_processes)]
+    output = ''.join(finish_cmd(process) for process in processes)
     print()
     print(output)
 
@@ -87,13 +102,21 @@ def visualize_sim():
     else:
         file_name = f'{constants.TMP_DIR}vis_{"".join(time.ctime().split(" "))}.txt'
 
-    output = run_cmd(constants.SIM_BIN, disease_name, graph_name)
-    print(output.split('\n')[-1])
     with open(file_name, 'w') as vis_file:
-        with open(graph_name, 'r') as graph_file:
-            graph_text = graph_file.readlines()
-            vis_file.writelines(graph_text + ([] if graph_text[-1] == '\n' else ['\n']))
-            vis_file.write(output)
+        write_graph_text(graph_name, vis_file)
+
+        # the simulation's output goes straight into the file, but its last line is a summary
+        last_line = ''
+
+        def write_line(line: str) -> None:
+            nonlocal last_line
+            vis_file.write(line)
+            last_line = line
+
+        run_cmd_streaming(constants.SIM_BIN, disease_name, graph_name, line_cb=write_line)
+    print(last_line.rstrip('\n'))
+    if save_vis:
+        forget_dir(constants.VIS_DIR)
     run_cmd(constants.VIS_BIN, file_name)
 
 
@@ -116,14 +139,14 @@ def create_new_disease():
     start_num_infected = int_input('How many nodes should be infectious at the start? ')
     with open(f'{constants.DISEASE_DIR}/{disease_name}.txt', 'w') as dis_file:
         dis_file.write(f'{time_to_i} {time_to_r} {inf_prob} {start_num_infected}\n')
+    forget_dir(constants.DISEASE_DIR)
 
 
 def select_file_from_dir(dir_name: str, prompt: str) -> str:
     """
     Read the contents of a directory and allow the user to select one of the files in it.
     """
-    file_names = filter(lambda gn: len(gn), run_cmd('ls', dir_name).split('\n'))
-    choices = dict(enumerate(file_names))
+    choices = dict(enumerate(ls_dir(dir_name).contents))
 
     selection = -1
     while selection not in choices.keys():
@@ -152,5 +175,16 @@ def print_func_choices(choices: Dict[int, Tuple[str, Any]]) -> None:
         print(choice[0], choice[1][0])
 
 
+# The main menu's choices, each with a plain English name and a function to call.
+# This is down here so that the functions already exist.
+_MENU = (('quit', exit),
+         ('analyze graph', analyze_graph),
+         ('run simulation batch', run_simulation_batch),
+         ('visualize simulation', visualize_sim),
+         ('load visualization', load_visualization),
+         ('create a new disease', create_new_disease))
+_MENU_MAP = {i: choice[1] for i, choice in enumerate(_MENU)}
+
+
 if __name__ == "__main__":
     main()
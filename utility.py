@@ -1,10 +1,13 @@
 from typing import Any, Optional, List
+import os
 import subprocess as sp
-import matplotlib.pyplot as plt
-import collections
+import time
+import sys
+import constants
 import numpy as np
-import networkx as nx
-from typing import Dict
+from typing import Callable, Dict, TextIO, Tuple, TYPE_CHECKING
+if TYPE_CHECKING:
+    from scipy.sparse import csr_matrix
 
 
 def safe_cast(obj: Any, T) -> Optional[int]:
@@ -24,8 +27,8 @@ def int_input(msg='') -> int:
     If the user doesn't input an int, it repeats the prompt.
     """
     x = safe_cast(input(msg), int)
-    if x is None:
-        x = int_input(msg)
+    while x is None:
+        x = safe_cast(input(msg), int)
     return x
 
 
@@ -49,10 +52,12 @@ def bool_input(msg='') -> bool:
 
 
 def int_list_input(msg='') -> List[int]:
-    xs = input(msg)
-    ints = [safe_cast(x, int) for x in xs.split(' ')]
-    if any((x is None for x in ints)):
-        int_list_input(msg)
+    """
+    Like int_input, but for a space separated list of ints.
+    """
+    ints = [safe_cast(x, int) for x in input(msg).split(' ')]
+    while any((x is None for x in ints)):
+        ints = [safe_cast(x, int) for x in input(msg).split(' ')]
     return ints
 
 
@@ -65,14 +70,55 @@ def run_cmd(cmd, *args, silent=False) -> str:
     :return: The stdout and stderr output that the command generated if it ran successfully.
     Otherwise, it returns '' after printing an error message.
     """
-    try:
-        raw_output = sp.check_output([cmd] + list(args), stderr=sp.STDOUT)
-        return raw_output.decode('utf-8')
-    except sp.CalledProcessError as e:
+    return finish_cmd(run_cmd_async(cmd, *args), silent=silent)
+
+
+def run_cmd_async(cmd, *args) -> sp.Popen:
+    """
+    Starts a terminal command without waiting for it to finish.
+    :param cmd: the name of the command.
+    :param args: the arguments to pass it (should be strings).
+    :return: The running process. Pass it to finish_cmd to get its output.
+    """
+    return sp.Popen([cmd] + list(args), stdout=sp.PIPE, stderr=sp.STDOUT)
+
+
+def finish_cmd(process: sp.Popen, silent=False) -> str:
+    """
+    Waits for a command started by run_cmd_async to finish.
+    :param silent: Whether or not to fail silently
+    :return: The stdout and stderr output that the command generated if it ran successfully.
+    Otherwise, it returns '' after printing an error message.
+    """
+    raw_output, _ = process.communicate()
+    if process.returncode != 0:
         if not silent:
             print('\nCould not execute command\n')
-            print(e)
+            print(sp.CalledProcessError(process.returncode, process.args, raw_output))
         return ''
+    return raw_output.decode('utf-8')
+
+
+def run_cmd_streaming(cmd, *args, line_cb: Callable[[str], None], silent=False) -> bool:
+    """
+    Runs a terminal command and hands its output to line_cb one line at a time
+    as the command produces it.
+    :param cmd: the name of the command.
+    :param args: the arguments to pass it (should be strings).
+    :param line_cb: called with each line of stdout and stderr output, newline included.
+    :param silent: Whether or not to fail silently
+    :return: Whether the command ran successfully. If it didn't, an error message is printed.
+    """
+    with sp.Popen([cmd] + list(args), stdout=sp.PIPE, stderr=sp.STDOUT,
+                  encoding='utf-8') as process:
+        for line in process.stdout:
+            line_cb(line)
+    if process.returncode != 0:
+        if not silent:
+            print('\nCould not execute command\n')
+            print(sp.CalledProcessError(process.returncode, process.args))
+        return False
+    return True
 
 
 class DirContents:
@@ -89,25 +135,88 @@ class DirContents:
         return len(self.contents)
 
 
+# seconds that a directory listing is reused before the directory is read again
+LS_CACHE_TTL = 10
+# the menus list these one after another, so ls_dir reads them all whenever it reads one
+LS_PREFETCH_DIRS = (constants.GRAPH_DIR, constants.DISEASE_DIR, constants.VIS_DIR)
+# directory name -> (time it was listed, file names)
+_ls_cache: Dict[str, Tuple[float, List[str]]] = {}
+
+
 def ls_dir(dir: str) -> DirContents:
-    files = [fn for fn in run_cmd('ls', dir).split('\n') if len(fn) > 1]
-    return DirContents(dir, files)
+    """
+    Lists the files in a directory. Listings are cached for LS_CACHE_TTL seconds,
+    so call forget_dir after writing to a directory.
+    """
+    now = time.monotonic()
+    if dir not in _ls_cache or now - _ls_cache[dir][0] > LS_CACHE_TTL:
+        _ls_cache[dir] = (now, _list_files(dir))
+        for other_dir in LS_PREFETCH_DIRS:
+            if other_dir != dir and os.path.isdir(other_dir):
+                _ls_cache[other_dir] = (now, _list_files(other_dir))
+    return DirContents(dir, list(_ls_cache[dir][1]))
+
+
+def _list_files(dir: str) -> List[str]:
+    try:
+        return sorted(entry.name for entry in os.scandir(dir)
+                      if entry.is_file() and not entry.name.startswith('.'))
+    except FileNotFoundError:
+        # diseases/ and visualizations/ don't exist until something is saved to them
+        return []
 
 
-def show_deg_dist_from_matrix(matrix: np.ndarray, title, *, color='b', display=False, save=False):
+def forget_dir(dir: str) -> None:
+    """
+    Drops the cached listing of a directory so that ls_dir reads it again.
+    """
+    _ls_cache.pop(dir, None)
+
+
+def write_graph_text(graph_name: str, vis_file: TextIO) -> None:
+    """
+    Copies a graph file to the start of a visualization file without reading the
+    whole graph into memory. The graph is followed by a blank line, which is added if
+    the graph file doesn't end with one.
+    """
+    tail = ''
+    with open(graph_name, 'r') as graph_file:
+        for chunk in iter(lambda: graph_file.read(1 << 16), ''):
+            vis_file.write(chunk)
+            tail = (tail + chunk)[-2:]
+    if tail != '\n\n':
+        vis_file.write('\n')
+
+
+def _import_pyplot():
+    """
+    pyplot takes a while to import, so it is only imported by the functions that plot.
+    :return: the matplotlib.pyplot module
+    """
+    import matplotlib
+    # With no display there is nothing a GUI backend could show, so don't pay to load one
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY') \
+            and not os.environ.get('WAYLAND_DISPLAY'):
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def show_deg_dist_from_matrix(matrix: 'csr_matrix', title, *, color='b', display=False, save=False):
     """
     This shows a degree distribution from a matrix.
-    :param matrix: The matrix.
+    :param matrix: The sparse adjacency matrix.
     :param title: The title.
     :param color: The color of the degree distribution.
     :param display: Whether or not to display it.
     :param save: Whether or not to save it.
     :return: None
     """
-    graph = nx.from_numpy_matrix(matrix)
-    degree_sequence = sorted([d for n, d in graph.degree()], reverse=True)
-    degree_count = collections.Counter(degree_sequence)
-    deg, cnt = zip(*degree_count.items())
+    plt = _import_pyplot()
+    # each row of the matrix has one entry per neighbor
+    deg, cnt = np.unique(matrix.getnnz(axis=1), return_counts=True)
+    # highest degree first
+    deg, cnt = deg[::-1], cnt[::-1]
 
     fig, ax = plt.subplots()
     plt.bar(deg, cnt, width=0.80, color=color)
@@ -123,38 +232,32 @@ def show_deg_dist_from_matrix(matrix: np.ndarray, title, *, color='b', display=F
         # print(title + ' displayed')
     if save:
         plt.savefig(title)
-        with open(title + '.csv', 'w') as file:
-            for i in range(len(cnt)):
-                file.write(f'{deg[i]},{cnt[i]}\n')
+        np.savetxt(title + '.csv', np.column_stack((deg, cnt)), fmt='%d', delimiter=',')
         # print(title + ' saved')
-    plt.clf()
+    plt.close(fig)
 
 
-def make_node_to_degree(adj_mat) -> List[int]:
-    node_to_degree = [0 for _ in range(adj_mat.shape[0])]
-    for i in range(adj_mat.shape[0]):
-        for j in range(adj_mat.shape[1]):
-            if adj_mat[i][j] > 0:
-                node_to_degree[i] += 1
-    return node_to_degree
+def make_node_to_degree(adj_mat: 'csr_matrix') -> List[int]:
+    return adj_mat.getnnz(axis=1).tolist()
 
 
 def show_clustering_coefficent_dist(node_to_coefficient: Dict[int, float], node_to_degree: Dict[int, int]) -> None:
-    degree_to_avg_coefficient = {}
-    for node, coefficient in node_to_coefficient.items():
-        if node_to_degree[node] not in degree_to_avg_coefficient:
-            degree_to_avg_coefficient[node_to_degree[node]] = []
-        degree_to_avg_coefficient[node_to_degree[node]].append(coefficient)
-    for degree, coefficients in degree_to_avg_coefficient.items():
-        degree_to_avg_coefficient[degree] = sum(coefficients)/len(coefficients)
-
-    plot_data = list(degree_to_avg_coefficient.items())
-    plot_data.sort(key=lambda e: e[0])
-    plt.plot(tuple(e[0] for e in plot_data), tuple(e[1] for e in plot_data))
+    plt = _import_pyplot()
+    degrees = np.fromiter((node_to_degree[node] for node in node_to_coefficient),
+                          dtype=np.int64, count=len(node_to_coefficient))
+    coefficients = np.fromiter(node_to_coefficient.values(), dtype=np.float64,
+                               count=len(node_to_coefficient))
+    # group the coefficients by degree
+    coefficient_sums = np.bincount(degrees, weights=coefficients)
+    node_counts = np.bincount(degrees)
+    present_degrees = np.nonzero(node_counts)[0]
+    avg_coefficients = coefficient_sums[present_degrees] / node_counts[present_degrees]
+
+    plt.plot(present_degrees, avg_coefficients)
     plt.xlabel('degree')
     plt.ylabel('average clustering coefficient')
 
-    avg_clustering_coefficient = sum((e[1] for e in plot_data)) / len(plot_data)
+    avg_clustering_coefficient = avg_coefficients.mean()
     print(f'Average clustering coefficient for all nodes: {avg_clustering_coefficient}')
 
     plt.show()